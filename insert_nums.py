@@ -16,7 +16,15 @@ class PromptInsertNumsCommand(sublime_plugin.WindowCommand):
 
 class InsertNumsCommand(sublime_plugin.TextCommand):
 
-    def run(self, edit, current, step, padding):
+    def run(self, edit, current, step, padding, lines=False, pattern=None, first_line=None, last_line=None, position="start"):
+        if lines:
+            # line mode is handled by text pastry, no cursors needed
+            self.view.run_command("text_pastry_command_wrapper", {
+                "command": "SequenceCommand",
+                "args": {"current": current, "step": step, "padding": padding},
+                "lines": True, "pattern": pattern, "first_line": first_line, "last_line": last_line, "position": position
+            })
+            return
         current = int(current)
         sel = self.view.sel()
         for region in sel:
@@ -10,6 +10,21 @@ import os
 import json
 import sys
 import hashlib
+import itertools
+import html
+import collections
+import csv
+import random
+import string
+import array
+import zlib
+import math
+import heapq
+import base64
+import binascii
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal, DecimalException, InvalidOperation, ROUND_HALF_UP
 from os.path import expanduser, normpath, join, isfile
 
 
@@ -359,12 +374,15 @@ class Command(object):
 class UUIDCommand(Command):
 
     def next(self, value, index, region):
-        text = str(uuid.uuid4())
-        if self.is_upper_case():
-            text = text.upper()
+        text = self.generate(self.is_upper_case())
         self.stack.append(text)
         return text
 
+    @staticmethod
+    def generate(uppercase=False):
+        text = str(uuid.uuid4())
+        return text.upper() if uppercase else text
+
     def is_upper_case(self):
         upper_case = False
         if self.options:
@@ -375,6 +393,20 @@ class UUIDCommand(Command):
         return True
 
 
+class SequenceCommand(Command):
+
+    def init(self, view, items=None):
+        self.start = int(self.options.get("current", 1))
+        self.step = int(self.options.get("step", 1))
+        self.format = "0" + str(self.options.get("padding", 1)) + "d"
+
+    def next(self, value, index, region):
+        return format(self.start + index * self.step, self.format)
+
+    def has_next(self):
+        return True
+
+
 class BackreferenceCommand(Command):
 
     def init(self, view, items=None):
@@ -398,23 +430,74 @@ class BackreferenceCommand(Command):
         self.stack = values
 
 
-class NodejsCommand(Command):
+class ResultCache(object):
+    # bounded LRU for results of pure transforms
+    _shared = None
 
-    def has_next(self):
-        return True
+    def __init__(self, size=10000):
+        self.size = size
+        self.entries = collections.OrderedDict()
 
-    def next(self, value, index, region):
+    @classmethod
+    def shared(cls, size=10000):
+        # survives between runs
+        if cls._shared is None:
+            cls._shared = cls(size)
+        cls._shared.size = size
+        return cls._shared
+
+    def get(self, key, compute):
+        if key in self.entries:
+            value = self.entries.pop(key)
+            self.entries[key] = value
+            return value
+        value = compute()
+        if value is not None:
+            self.entries[key] = value
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+        return value
+
+
+class NodejsCommand(Command):
+
+    def init(self, view, items=None):
+        super(NodejsCommand, self).init(view, items)
+        # read the script file once per run
+        self.script = self.load_script()
+        self.cache = None
+        if self.options.get("pure", False):
+            settings = sublime.load_settings("TextPastry.sublime-settings")
+            size = settings.get("transform_cache_size", 10000)
+            self.cache = ResultCache.shared(size) if self.options.get("persistent", False) else ResultCache(size)
+            # results only depend on the script and the value
+            script = json.dumps([self.script, self.options.get("file") is not None, self.options.get("sugar", True)])
+            self.script_hash = hashlib.md5(script.encode('UTF-8')).hexdigest()
+
+    def load_script(self):
         file = self.options.get("file", None)
         folder = self.options.get("folder", None)
-        script = self.options.get("script", None)
-        sugar = self.options.get("sugar", True)
         if file:
             folder = folder if folder else expanduser("~")
             file = normpath(join(folder, file))
             if isfile(file):
                 with open(file, "r") as f:
-                    script = f.read()
-        elif script and sugar:
+                    return f.read()
+            return None
+        return self.options.get("script", None)
+
+    def has_next(self):
+        return True
+
+    def next(self, value, index, region):
+        if self.cache is not None:
+            return self.cache.get((self.script_hash, value), lambda: self.evaluate(value, index, region))
+        return self.evaluate(value, index, region)
+
+    def evaluate(self, value, index, region):
+        script = self.script
+        sugar = self.options.get("sugar", True)
+        if script and sugar and not self.options.get("file", None):
             if not 'return ' in script and not ';' in script:
                 script = "value = " + script
             script = 'var result=(function(value, index, begin, end){{{SCRIPT};return value;}}({VALUE}, {INDEX}, {BEGIN}, {END}));process.stdout.write('' + result);'.format(
@@ -440,10 +523,122 @@ class NodejsCommand(Command):
         return None
 
 
+# ========================================
+# bulk_edit.py
+# ========================================
+class BulkEdit(object):
+    # reads and replaces all regions in one edit, back to front so earlier regions keep their offsets
+
+    def __init__(self, view, edit, regions=None):
+        self.view = view
+        self.edit = edit
+        self.regions = list(view.sel()) if regions is None else regions
+
+    def texts(self):
+        return [self.view.substr(region) for region in self.regions]
+
+    def replace(self, values):
+        # values[idx] is None keeps the region as it is
+        sizes = []
+        for idx in range(len(self.regions) - 1, -1, -1):
+            region = self.regions[idx]
+            value = values[idx] if idx < len(values) else None
+            if value is None:
+                sizes.append(region.size())
+            else:
+                self.view.replace(self.edit, region, value)
+                sizes.append(len(value))
+        sizes.reverse()
+        regions = []
+        delta = 0
+        for (region, size) in zip(self.regions, sizes):
+            regions.append(sublime.Region(region.begin() + delta, region.begin() + delta + size))
+            delta += size - region.size()
+        return regions
+
+    def select(self, regions, cursor=True):
+        sel = self.view.sel()
+        sel.clear()
+        if cursor:
+            regions = [sublime.Region(region.end(), region.end()) for region in regions]
+        sel.add_all(regions)
+
+
+# ========================================
+# line_mode.py
+# ========================================
+class LineMode(object):
+    # targets every line (or every line matching pattern) without creating a cursor for each one
+    commands = ('insert_nums', 'text_pastry_insert_text', 'text_pastry_command_wrapper', 'text_pastry_uuid', 'text_pastry_nodejs')
+
+    def __init__(self, view, pattern=None, first_line=None, last_line=None, position="start"):
+        self.view = view
+        self.pattern = re.compile(pattern) if pattern else None
+        self.first_line = first_line
+        self.last_line = last_line
+        if position not in ('start', 'end', 'replace'):
+            raise ValueError('Unknown line position: ' + str(position))
+        self.position = position
+
+    def span(self):
+        view = self.view
+        if self.first_line is None and self.last_line is None:
+            sel = view.sel()
+            # a single selection limits the lines, otherwise use the whole buffer
+            if len(sel) == 1 and not sel[0].empty():
+                return sublime.Region(view.line(sel[0].begin()).begin(), view.line(sel[0].end()).end())
+            return sublime.Region(0, view.size())
+        first = max(int(self.first_line or 1), 1)
+        begin = view.text_point(first - 1, 0)
+        if self.last_line is None:
+            return sublime.Region(begin, view.size())
+        end = view.line(view.text_point(max(int(self.last_line), first) - 1, 0)).end()
+        return sublime.Region(begin, end)
+
+    def apply(self, edit, generator):
+        # generator(index, line, region) returns the new value or None to stop
+        span = self.span()
+        text = self.view.substr(span)
+        result = []
+        index = 0
+        offset = span.begin()
+        lines = text.split('\n')
+        # a trailing newline does not start another line
+        trailing = len(lines) > 1 and lines[-1] == ''
+        if trailing:
+            lines.pop()
+        for (number, line) in enumerate(lines):
+            size = len(line)
+            if self.pattern is None or self.pattern.search(line):
+                value = generator(index, line, sublime.Region(offset, offset + len(line)))
+                if value is None:
+                    result.extend(lines[number:])
+                    break
+                index += 1
+                if self.position == 'start':
+                    line = value + line
+                elif self.position == 'end':
+                    line = line + value
+                else:
+                    line = value
+            result.append(line)
+            offset += size + 1
+        if trailing:
+            result.append('')
+        self.view.replace(edit, span, '\n'.join(result))
+        sel = self.view.sel()
+        sel.clear()
+        sel.add(sublime.Region(span.begin(), span.begin()))
+        sublime.status_message("Updated {0} lines".format(index))
+        return index
+
+
 # ========================================
 # parser.py
 # ========================================
 class Parser:
+    _matches = None
+    _patterns = None
 
     def parse(self, text):
         if not text:
@@ -452,7 +647,19 @@ class Parser:
         result = None
         m5 = re.match('^(\$\d+\s?)+$', text)
         m8 = re.match('^cmd ([\w_]+)(.*?)', text)
-        if m5:
+        m9 = self.line_mode(text)
+        if m9:
+            # line mode, e.g. "lines 1 1 3" or "lines /ERROR/ uuid"
+            result = self.parse(m9.group(2))
+            if result and result['command'] in LineMode.commands:
+                args = dict(result.get('args') or {})
+                args['lines'] = True
+                args['pattern'] = m9.group(1)
+                result = dict(command=result['command'], args=args)
+            elif result:
+                sublime.status_message('Line mode is not supported by ' + result['command'])
+                result = None
+        elif m5:
             # backref
             items = ','.join(filter(None, map(lambda x: x.strip(), text.split('$'))))
             result = dict(command='text_pastry_insert', args={'command': 'backreference', 'text': items, 'separator': ','})
@@ -473,18 +680,9 @@ class Parser:
                 result = self.create_command(shortcuts[text])
             if not result:
                 # check regex
-                for item in cmd_shortcuts:
-                    comp = re.compile(item['match'])
-                    match = comp.match(text)
-                    if match:
-                        # create dict with backreferences
-                        refs = {}
-                        for (key, value) in enumerate(match.groups()):
-                            refs['$' + str(key + 1)] = value
-                        # add other stuff to references
-                        refs['$clipbord'] = sublime.get_clipboard()
-                        result = self.create_command(item, refs)
-                        break
+                (item, match) = self.match(text, cmd_shortcuts)
+                if item:
+                    result = self.create_command(item, self.references(match))
             if not result:
                 # default is words
                 sublime.status_message('Inserting text: ' + text)
@@ -497,6 +695,39 @@ class Parser:
             print('Text Pastry: no match found, doing nothing')
         return result
 
+    def line_mode(self, text):
+        m = re.match('^lines(?:\s*/(.*?)/)?\s+(.+)$', text)
+        settings = sublime.load_settings('TextPastry.sublime-settings')
+        # only shortcuts run in line mode, anything else is regular text
+        if m and self.match(m.group(2), settings.get('cmd_shortcuts'))[0]:
+            return m
+        return None
+
+    @classmethod
+    def patterns(cls, cmd_shortcuts):
+        # compile the shortcuts once, until the settings change
+        matches = [item['match'] for item in cmd_shortcuts]
+        if matches != cls._matches:
+            cls._patterns = [re.compile(match) for match in matches]
+            cls._matches = matches
+        return cls._patterns
+
+    def match(self, text, cmd_shortcuts):
+        for (item, comp) in zip(cmd_shortcuts, self.patterns(cmd_shortcuts)):
+            match = comp.match(text)
+            if match:
+                return (item, match)
+        return (None, None)
+
+    def references(self, match):
+        # create dict with backreferences
+        refs = {}
+        for (key, value) in enumerate(match.groups()):
+            refs['$' + str(key + 1)] = value
+        # add other stuff to references
+        refs['$clipbord'] = sublime.get_clipboard()
+        return refs
+
     def create_command(self, shortcut, refs=None):
         cmd = shortcut['command']
         args = None
@@ -539,15 +770,175 @@ class CommandParser(object):
         return dict(command=self.command, args=self.args)
 
 
+# ========================================
+# clipboard_ring.py
+# ========================================
+class ClipboardRing(object):
+    # recent clipboard contents, compressed, most recent last
+    _entries = collections.OrderedDict()
+    _size = 0
+    _last = (None, None)
+
+    @classmethod
+    def settings(cls):
+        return sublime.load_settings("TextPastry.sublime-settings")
+
+    @classmethod
+    def push(cls, text):
+        if not text or not cls.settings().get("clipboard_ring_enabled", True):
+            return
+        (last, last_key) = cls._last
+        if text == last and last_key in cls._entries:
+            # unchanged clipboard, skip encoding and hashing it again
+            return
+        data = text.encode('UTF-8')
+        key = hashlib.sha1(data).hexdigest()
+        cls._last = (text, key)
+        if key in cls._entries:
+            # already known, just mark as recently used
+            cls._entries[key] = cls._entries.pop(key)
+            return
+        compressed = zlib.compress(data)
+        cls._entries[key] = compressed
+        cls._size += len(compressed)
+        cls.evict()
+
+    @classmethod
+    def evict(cls):
+        settings = cls.settings()
+        max_bytes = settings.get("clipboard_ring_max_bytes", 16 * 1024 * 1024)
+        max_entries = settings.get("clipboard_ring_max_entries", 50)
+        while cls._entries and (cls._size > max_bytes or len(cls._entries) > max_entries):
+            (key, compressed) = cls._entries.popitem(last=False)
+            cls._size -= len(compressed)
+
+    @classmethod
+    def get(cls, index=0):
+        # 0 is the most recent entry, 1 the one before...
+        index = int(index)
+        if index < 0 or index >= len(cls._entries):
+            return None
+        key = next(itertools.islice(reversed(cls._entries), index, None))
+        return zlib.decompress(cls._entries[key]).decode('UTF-8')
+
+    @classmethod
+    def clipboard(cls, index=0):
+        # the current clipboard may come from another application and is not in the ring yet
+        cls.push(sublime.get_clipboard())
+        return cls.get(index)
+
+    @classmethod
+    def size(cls):
+        return len(cls._entries)
+
+
+class TextPastryClipboardListener(sublime_plugin.EventListener):
+
+    def on_post_text_command(self, view, command_name, args):
+        if command_name in ('copy', 'cut'):
+            ClipboardRing.push(sublime.get_clipboard())
+
+    def on_activated(self, view):
+        # picks up text copied in other applications
+        ClipboardRing.push(sublime.get_clipboard())
+
+
 # ========================================
 # paste.py
 # ========================================
+class LineIndex(object):
+    # start offsets of every line, stored in a compact array instead of a list of strings
+
+    def __init__(self, text):
+        self.text = text
+        self.offsets = array.array('l', [0])
+        position = text.find('\n')
+        while position >= 0:
+            self.offsets.append(position + 1)
+            position = text.find('\n', position + 1)
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def line(self, index):
+        begin = self.offsets[index]
+        end = self.offsets[index + 1] - 1 if index + 1 < len(self.offsets) else len(self.text)
+        return self.text[begin:end]
+
+    def width(self):
+        width = 0
+        for index in range(len(self.offsets)):
+            end = self.offsets[index + 1] - 1 if index + 1 < len(self.offsets) else len(self.text)
+            width = max(width, end - self.offsets[index])
+        return width
+
+
+class PasteBlock(object):
+
+    def __init__(self, view, text):
+        # a trailing newline does not start another row
+        if text.endswith('\n'):
+            text = text[:-1]
+        self.view = view
+        self.index = LineIndex(text)
+
+    def paste(self, edit, point):
+        view = self.view
+        tab_size = view.settings().get('tab_size', 4)
+        row = view.rowcol(point)[0]
+        rows = len(self.index)
+        width = self.index.width()
+        begin = view.line(point).begin()
+        # rowcol counts a tab as one column, use the column on screen instead
+        column = len(view.substr(sublime.Region(begin, point)).expandtabs(tab_size))
+        last = view.rowcol(view.size())[0]
+        end = view.line(view.text_point(min(row + rows - 1, last), 0)).end()
+        lines = view.substr(sublime.Region(begin, end)).split('\n')
+        result = []
+        for idx in range(rows):
+            value = self.index.line(idx)
+            line = lines[idx] if idx < len(lines) else ''
+            (offset, visual) = self.offset(line, column, tab_size)
+            # pad short lines up to the cursor column
+            head = line[:offset] + ' ' * (column - visual)
+            if offset < len(line):
+                # keep text right of the block aligned
+                result.append(head + value.ljust(width) + line[offset:])
+            else:
+                result.append(head + value)
+        text = '\n'.join(result)
+        view.replace(edit, sublime.Region(begin, end), text)
+        # cursor at the end of the last pasted row
+        return begin + len(text) - len(result[-1]) + len(head) + len(value)
+
+    @staticmethod
+    def offset(line, column, tab_size):
+        # character offset and screen column where the block starts in line
+        visual = 0
+        for (offset, char) in enumerate(line):
+            size = tab_size - visual % tab_size if char == '\t' else 1
+            if visual + size > column:
+                # stops in front of a tab that spans the column
+                return (offset, visual)
+            visual += size
+        return (len(line), visual)
+
+
 class TextPastryPasteCommand(sublime_plugin.TextCommand):
 
-    def run(self, edit):
+    def run(self, edit, block=False):
         try:
             text = sublime.get_clipboard()
-            if text is not None and len(text) > 0:
+            if text and block:
+                # only the first cursor is used, its selection is replaced
+                sel = self.view.sel()
+                region = sel[0]
+                if not region.empty():
+                    self.view.erase(edit, region)
+                point = PasteBlock(self.view, text).paste(edit, region.begin())
+                sel.clear()
+                sel.add(sublime.Region(point, point))
+            elif text is not None and len(text) > 0:
                 regions = []
                 sel = self.view.sel()
                 items = text.split("\n")
@@ -604,6 +995,234 @@ class TextPastryRedoCommand(sublime_plugin.WindowCommand):
                     pass
 
 
+# ========================================
+# splitter.py
+# ========================================
+class Splitter(object):
+
+    @staticmethod
+    def split(text, separator=None, regex=False):
+        # lazy version of str.split and re.split, yields one segment at a time
+        if regex:
+            position = 0
+            for match in re.finditer(separator, text):
+                if match.end() == match.start():
+                    continue
+                yield text[position:match.start()]
+                position = match.end()
+            yield text[position:]
+        elif separator is None:
+            for match in re.finditer(r'\S+', text):
+                yield match.group(0)
+        else:
+            position = 0
+            size = len(separator)
+            while True:
+                index = text.find(separator, position)
+                if index < 0:
+                    break
+                yield text[position:index]
+                position = index + size
+            yield text[position:]
+
+    @staticmethod
+    def trim(segments):
+        # drops the empty segment after a trailing separator
+        previous = None
+        for segment in segments:
+            if previous is not None:
+                yield previous
+            previous = segment
+        if previous:
+            yield previous
+
+    @staticmethod
+    def lines(text):
+        # like text.splitlines(True) without building the list
+        position = 0
+        length = len(text)
+        while position < length:
+            index = text.find('\n', position)
+            if index < 0:
+                yield text[position:]
+                break
+            yield text[position:index + 1]
+            position = index + 1
+
+
+# ========================================
+# sampling.py
+# ========================================
+class Reservoir(object):
+    # single pass samples over a stream of unknown length, memory only depends on size
+
+    def __init__(self, seed=None):
+        self.random = random.Random(seed)
+
+    def uniform(self):
+        # (0, 1), safe to use with log
+        value = self.random.random()
+        while value == 0.0:
+            value = self.random.random()
+        return value
+
+    def sample(self, stream, size):
+        # Algorithm L, skips over the stream instead of drawing a number for each item
+        stream = iter(stream)
+        reservoir = list(itertools.islice(stream, size))
+        if size <= 0 or len(reservoir) < size:
+            self.random.shuffle(reservoir)
+            return reservoir
+        w = math.exp(math.log(self.uniform()) / size)
+        while True:
+            skip = int(math.log(self.uniform()) / math.log(1 - w)) if w < 1 else 0
+            item = next(itertools.islice(stream, skip, None), None)
+            if item is None:
+                break
+            reservoir[self.random.randrange(size)] = item
+            w *= math.exp(math.log(self.uniform()) / size)
+        # the reservoir keeps the stream order for the first items
+        self.random.shuffle(reservoir)
+        return reservoir
+
+    def sample_with_replacement(self, stream, size):
+        # one reservoir of size 1 per slot, slots wait in a heap for their next replacement
+        reservoir = [None] * size
+        queue = [(1, slot) for slot in range(size)]
+        count = 0
+        for (position, item) in enumerate(stream, 1):
+            count = position
+            while queue and queue[0][0] == position:
+                (_, slot) = heapq.heappop(queue)
+                reservoir[slot] = item
+                # P(next replacement > j) = position / j
+                heapq.heappush(queue, (int(position / self.uniform()) + 1, slot))
+        return reservoir if count else []
+
+
+# ========================================
+# structured.py
+# ========================================
+class StructuredReader(object):
+    delimiters = {'csv': ',', 'tsv': '\t'}
+
+    def __init__(self, text, format='csv', column=None, key=None, rows=None):
+        self.text = text
+        self.format = format
+        self.column = column
+        self.key = key
+        (self.first, self.last) = self.parse_range(rows)
+
+    @staticmethod
+    def parse_range(rows):
+        # 1-based, inclusive "N:M", both sides are optional
+        if not rows:
+            return (1, None)
+        rows = str(rows)
+        if ':' not in rows:
+            return (int(rows), int(rows))
+        (first, last) = rows.split(':', 1)
+        return (int(first) if first else 1, int(last) if last else None)
+
+    def records(self):
+        if self.format in self.delimiters:
+            records = self.csv_records()
+        elif self.format == 'json':
+            records = self.json_records()
+        else:
+            raise ValueError('Unknown format: ' + str(self.format))
+        for (row, value) in enumerate(records, 1):
+            if self.last is not None and row > self.last:
+                break
+            if row >= self.first:
+                yield value
+
+    def items(self, limit=None):
+        return list(itertools.islice(self.records(), limit))
+
+    @staticmethod
+    def column_index(column):
+        # columns start at 1
+        if int(column) < 1:
+            raise ValueError('Invalid column')
+        return int(column) - 1
+
+    def csv_records(self):
+        reader = csv.reader(Splitter.lines(self.text), delimiter=self.delimiters[self.format])
+        index = None
+        column = self.column
+        if column is not None and not str(column).lstrip('-').isdigit():
+            # column is a header name, first row is the header
+            try:
+                header = next(reader)
+            except StopIteration:
+                return
+            except csv.Error as e:
+                raise ValueError(str(e))
+            if column not in header:
+                raise ValueError('Column not found: ' + column)
+            index = header.index(column)
+        elif column is not None:
+            index = self.column_index(column)
+        while True:
+            try:
+                row = next(reader)
+            except StopIteration:
+                return
+            except csv.Error as e:
+                raise ValueError(str(e))
+            if index is None:
+                yield self.delimiters[self.format].join(row)
+            else:
+                yield row[index] if -len(row) <= index < len(row) else ''
+
+    def json_records(self):
+        decoder = json.JSONDecoder()
+        text = self.text
+        length = len(text)
+
+        def skip(position):
+            while position < length and text[position] in ' \t\r\n':
+                position += 1
+            return position
+        position = skip(0)
+        if position >= length or text[position] != '[':
+            raise ValueError('No JSON array found')
+        position = skip(position + 1)
+        if position < length and text[position] == ']':
+            return
+        while True:
+            (value, position) = decoder.raw_decode(text, position)
+            yield self.json_value(value)
+            position = skip(position)
+            if position >= length:
+                raise ValueError('Unterminated JSON array')
+            if text[position] == ']':
+                return
+            if text[position] != ',':
+                raise ValueError('Expecting , in JSON array at position {0}'.format(position))
+            position = skip(position + 1)
+
+    def json_value(self, value):
+        if self.key:
+            for part in str(self.key).split('.'):
+                if isinstance(value, list) and part.lstrip('-').isdigit():
+                    index = int(part)
+                    value = value[index] if -len(value) <= index < len(value) else None
+                elif isinstance(value, dict):
+                    value = value.get(part)
+                else:
+                    value = None
+                if value is None:
+                    return ''
+        elif self.column is not None and isinstance(value, list):
+            index = self.column_index(self.column)
+            value = value[index] if -len(value) <= index < len(value) else ''
+        if isinstance(value, str):
+            return value
+        return json.dumps(value)
+
+
 # ========================================
 # insert_text.py
 # ========================================
@@ -611,13 +1230,39 @@ class TextPastryInsertTextCommand(sublime_plugin.TextCommand):
 
     def run(self, edit, text=None, separator=None, clipboard=False,
             items=None, regex=False, keep_selection=None, repeat=None, strip=None,
-            threshold=1):
+            threshold=1, structured=None, column=None, key=None, rows=None,
+            lines=False, pattern=None, first_line=None, last_line=None, position="start", ring=None,
+            preset=None, sample=False, seed=None, replacement=False):
         try:
+            settings = sublime.load_settings("TextPastry.sublime-settings")
             if separator:
                 separator = separator.encode('utf8').decode("unicode-escape")
-            if clipboard:
+            if clipboard and ring:
+                # older clipboard content from the clipboard ring
+                text = ClipboardRing.clipboard(ring)
+            elif clipboard:
                 text = sublime.get_clipboard()
-            if text:
+            if preset:
+                presets = settings.get("presets", {})
+                if preset not in presets:
+                    sublime.status_message("Preset not found: " + preset)
+                    return
+                text = None
+                items = list(presets[preset])
+            if sample and (text or items):
+                # stream the source, only keep one item per target
+                source = Splitter.trim(Splitter.split(text, separator, regex)) if text else items
+                size = self.sample_size(lines, pattern, first_line, last_line)
+                reservoir = Reservoir(seed)
+                if replacement:
+                    items = reservoir.sample_with_replacement(source, size)
+                else:
+                    items = reservoir.sample(source, size)
+            elif text and structured:
+                # only parse as many records as we have selections
+                reader = StructuredReader(text, structured, column=column, key=key, rows=rows)
+                items = reader.items(limit=None if lines else len(self.view.sel()))
+            elif text:
                 if regex:
                     items = re.split(separator, text)
                 else:
@@ -628,7 +1273,6 @@ class TextPastryInsertTextCommand(sublime_plugin.TextCommand):
                 sel = self.view.sel()
                 if strip is None:
                     strip = False
-                    settings = sublime.load_settings("TextPastry.sublime-settings")
                     if separator == "\n" and settings.has("clipboard_strip_newline"):
                         strip = settings.get("clipboard_strip_newline")
                 if repeat is None:
@@ -636,6 +1280,14 @@ class TextPastryInsertTextCommand(sublime_plugin.TextCommand):
                         repeat = settings.get("repeat_clipboard")
                     elif settings.has("repeat_words"):
                         repeat = settings.get("repeat_words")
+                if lines:
+                    def generator(index, line, region):
+                        if index >= len(items) and not repeat:
+                            return None
+                        current = items[index % len(items)]
+                        return current.strip() if strip else current
+                    LineMode(self.view, pattern, first_line, last_line, position).apply(edit, generator)
+                    return
                 if repeat and items:
                     while (len(items) < len(sel)):
                         items.extend(items)
@@ -664,6 +1316,17 @@ class TextPastryInsertTextCommand(sublime_plugin.TextCommand):
         except ValueError:
             sublime.status_message("Error while executing Insert Text, canceled")
             pass
+        except re.error as e:
+            sublime.status_message("Invalid line pattern: " + str(e))
+
+    def sample_size(self, lines, pattern, first_line, last_line):
+        if not lines:
+            return len(self.view.sel())
+        line_mode = LineMode(self.view, pattern, first_line, last_line)
+        text = self.view.substr(line_mode.span())
+        if line_mode.pattern:
+            return sum(1 for line in Splitter.trim(Splitter.split(text, '\n')) if line_mode.pattern.search(line))
+        return text.count('\n') + (0 if text.endswith('\n') else 1)
 
 
 # ========================================
@@ -679,29 +1342,780 @@ class TextPastrySettingCommand(sublime_plugin.TextCommand):
 
 class TextPastryUuidCommand(sublime_plugin.TextCommand):
 
-    def run(self, edit, uppercase=False):
+    def run(self, edit, uppercase=False, lines=False, pattern=None):
         settings = sublime.load_settings("TextPastry.sublime-settings")
         uppercase = settings.get("force_uppercase_uuid", False) or uppercase
         self.view.run_command("text_pastry_command_wrapper", {
             "command": "UUIDCommand",
-            "args": {"uppercase": uppercase}
+            "args": {"uppercase": uppercase},
+            "lines": lines,
+            "pattern": pattern
         })
 
 
 class TextPastryNodejsCommand(sublime_plugin.TextCommand):
 
-    def run(self, edit, file=None, folder=None, script=None, sugar=True):
+    def run(self, edit, file=None, folder=None, script=None, sugar=True, pure=False, persistent=False,
+            lines=False, pattern=None):
         self.view.run_command("text_pastry_command_wrapper", {
             "command": "NodejsCommand",
             "args": {
                 "file": file,
                 "folder": folder,
                 "script": script,
-                "sugar": sugar
-            }
+                "sugar": sugar,
+                "pure": pure,
+                "persistent": persistent
+            },
+            "lines": lines,
+            "pattern": pattern
         })
 
 
+# ========================================
+# case_conversion.py
+# ========================================
+class CaseConverter(object):
+    _tokenizer = None
+
+    @classmethod
+    def tokenizer(cls):
+        # build the unicode aware word boundary regex once
+        if cls._tokenizer is None:
+            upper = cls.char_class(c for c in map(chr, range(sys.maxunicode + 1)) if c.isupper())
+            U = '[' + upper + ']'
+            L = '[^\\W\\d_' + upper + ']'
+            pattern = '{U}+(?={U}{L})|{U}?{L}+\\d*|{U}+\\d*|\\d+'.format(U=U, L=L)
+            cls._tokenizer = re.compile(pattern)
+        return cls._tokenizer
+
+    @staticmethod
+    def char_class(chars):
+        # compress code points into ranges to keep the pattern small
+        ranges = []
+        for c in chars:
+            o = ord(c)
+            if ranges and ranges[-1][1] == o - 1:
+                ranges[-1][1] = o
+            else:
+                ranges.append([o, o])
+        return ''.join(re.escape(chr(a)) if a == b else re.escape(chr(a)) + '-' + re.escape(chr(b)) for a, b in ranges)
+
+    @classmethod
+    def words(cls, text):
+        return cls.tokenizer().findall(text)
+
+    @staticmethod
+    def capitalize(word):
+        return word[:1].upper() + word[1:].lower()
+
+    @classmethod
+    def convert(cls, text, case):
+        words = cls.words(text)
+        if not words:
+            return text
+        if case == 'snake':
+            return '_'.join(w.lower() for w in words)
+        elif case == 'constant':
+            return '_'.join(w.upper() for w in words)
+        elif case == 'dot':
+            return '.'.join(w.lower() for w in words)
+        elif case == 'dash':
+            return '-'.join(w.lower() for w in words)
+        elif case == 'pascal':
+            return ''.join(cls.capitalize(w) for w in words)
+        elif case == 'camel':
+            return words[0].lower() + ''.join(cls.capitalize(w) for w in words[1:])
+        raise ValueError('Unknown case: ' + str(case))
+
+
+class TextPastryConvertCaseCommand(sublime_plugin.TextCommand):
+
+    def run(self, edit, case="snake"):
+        try:
+            sel = self.view.sel()
+            # expand empty selections to the word under the cursor
+            regions = []
+            for region in sel:
+                if region.empty():
+                    region = self.view.word(region)
+                # two cursors in the same word
+                if regions and region.begin() < regions[-1].end():
+                    continue
+                regions.append(region)
+            bulk = BulkEdit(self.view, edit, regions)
+            cache = {}
+            values = []
+            for text in bulk.texts():
+                if text not in cache:
+                    cache[text] = CaseConverter.convert(text, case)
+                values.append(cache[text])
+            bulk.select(bulk.replace(values), cursor=False)
+            sublime.status_message("Converted {0} selections to {1} case".format(len(values), case))
+        except ValueError:
+            sublime.status_message("Error while converting case, canceled")
+
+
+# ========================================
+# reorder.py
+# ========================================
+class SortKey(object):
+    digits = re.compile(r'(\d+)')
+    number = re.compile(r'^\s*[-+]?(\d+\.?\d*|\.\d+)([eE][-+]?\d+)?\s*$')
+
+    @classmethod
+    def natural(cls, text):
+        # alternating text and number parts, so the types line up for every key
+        parts = cls.digits.split(text.lower())
+        return tuple(int(part) if idx % 2 else part for idx, part in enumerate(parts))
+
+    @classmethod
+    def numeric(cls, text):
+        # non numeric values are sorted to the end
+        if cls.number.match(text):
+            return (0, float(text), '')
+        return (1, 0, text)
+
+    @staticmethod
+    def text(text):
+        return text
+
+    @staticmethod
+    def ignore_case(text):
+        return text.lower()
+
+    @classmethod
+    def get(cls, name):
+        if name in ('natural', 'numeric', 'text', 'ignore_case'):
+            return getattr(cls, name)
+        raise ValueError('Unknown sort key: ' + str(name))
+
+    @staticmethod
+    def decorate(texts, key):
+        # compute each key once, duplicates share the parsed key
+        cache = {}
+        keys = []
+        for text in texts:
+            if text not in cache:
+                cache[text] = key(text)
+            keys.append(cache[text])
+        return keys
+
+
+class SelectionReorder(object):
+
+    @staticmethod
+    def run(view, edit, reorder):
+        bulk = BulkEdit(view, edit)
+        texts = bulk.texts()
+        if not texts:
+            return
+        values = reorder(texts)
+        # unused selections are emptied, e.g. after removing duplicates
+        values.extend([''] * (len(texts) - len(values)))
+        bulk.select(bulk.replace(values), cursor=False)
+
+    @staticmethod
+    def sort(texts, key='natural', reverse=False, unique=False):
+        if unique:
+            texts = SelectionReorder.unique(texts)
+        keys = SortKey.decorate(texts, SortKey.get(key))
+        order = sorted(range(len(texts)), key=keys.__getitem__, reverse=reverse)
+        return [texts[idx] for idx in order]
+
+    @staticmethod
+    def unique(texts, ignore_case=False):
+        seen = set()
+        values = []
+        for text in texts:
+            key = text.lower() if ignore_case else text
+            if key not in seen:
+                seen.add(key)
+                values.append(text)
+        return values
+
+    @staticmethod
+    def shuffle(texts, seed=None):
+        values = list(texts)
+        random.Random(seed).shuffle(values)
+        return values
+
+
+class TextPastrySortCommand(sublime_plugin.TextCommand):
+
+    def run(self, edit, key="natural", reverse=False, unique=False):
+        try:
+            SelectionReorder.run(self.view, edit, lambda texts: SelectionReorder.sort(texts, key, reverse, unique))
+        except ValueError:
+            sublime.status_message("Error while sorting selections, canceled")
+
+
+class TextPastryUniqueCommand(sublime_plugin.TextCommand):
+
+    def run(self, edit, ignore_case=False):
+        SelectionReorder.run(self.view, edit, lambda texts: SelectionReorder.unique(texts, ignore_case))
+
+
+class TextPastryReverseCommand(sublime_plugin.TextCommand):
+
+    def run(self, edit):
+        SelectionReorder.run(self.view, edit, lambda texts: texts[::-1])
+
+
+class TextPastryShuffleCommand(sublime_plugin.TextCommand):
+
+    def run(self, edit, seed=None):
+        SelectionReorder.run(self.view, edit, lambda texts: SelectionReorder.shuffle(texts, seed))
+
+
+# ========================================
+# arithmetic.py
+# ========================================
+class NumberFormat(object):
+    pattern = re.compile(r'^(\s*)([-+]?)(?:(0[xXoObB])([0-9a-fA-F]+)|(\d+(?:\.\d+)?))(\s*)$')
+    bases = {'x': 16, 'o': 8, 'b': 2}
+    max_decimals = 10
+
+    def __init__(self, match):
+        (self.before, self.sign, self.prefix, radix_digits, decimal_digits, self.after) = match.groups()
+        self.digits = radix_digits or decimal_digits
+        self.base = self.bases[self.prefix[1].lower()] if self.prefix else 10
+        (integer, _, fraction) = self.digits.partition('.')
+        # zero padded numbers keep their width
+        self.width = len(integer) if len(integer) > 1 and integer[0] == '0' else 0
+        self.decimals = len(fraction)
+        self.upper = self.base == 16 and self.digits != self.digits.lower()
+
+    @classmethod
+    def parse(cls, text):
+        match = cls.pattern.match(text)
+        if not match:
+            return None
+        number = cls(match)
+        if number.base != 10:
+            try:
+                int(number.digits, number.base)
+            except ValueError:
+                return None
+        return number
+
+    def value(self):
+        # plain int when possible, it is a lot faster than Decimal
+        if self.decimals:
+            value = Decimal(self.digits)
+        else:
+            value = int(self.digits, self.base)
+        return -value if self.sign == '-' else value
+
+    def format(self, value):
+        if self.decimals and isinstance(value, int):
+            value = Decimal(value)
+        if not isinstance(value, int):
+            rounded = value.quantize(Decimal(1).scaleb(-self.decimals), rounding=ROUND_HALF_UP)
+            if rounded == value:
+                value = rounded if self.decimals else int(rounded)
+            elif self.base != 10:
+                raise ValueError('Fractional result for a base {0} number'.format(self.base))
+            else:
+                # keep the fraction instead of silently rounding it away, up to max_decimals places
+                value = value.quantize(Decimal(1).scaleb(-self.max_decimals), rounding=ROUND_HALF_UP).normalize()
+        sign = '-' if value < 0 else ('+' if self.sign == '+' else '')
+        value = abs(value)
+        if self.base == 10:
+            digits = str(value) if isinstance(value, int) else '{0:f}'.format(value)
+            (integer, dot, fraction) = digits.partition('.')
+            digits = integer.zfill(self.width) + dot + fraction
+        else:
+            digits = format(value, {16: 'x', 8: 'o', 2: 'b'}[self.base]).zfill(self.width)
+            if self.upper:
+                digits = digits.upper()
+        return self.before + sign + (self.prefix or '') + digits + self.after
+
+
+class Arithmetic(object):
+    operators = {
+        '+': operator.add,
+        '-': operator.sub,
+        '*': operator.mul,
+        '/': lambda value, operand: Decimal(value) / Decimal(operand),
+        '%': lambda value, operand: Arithmetic.modulo(value, operand),
+        '=': lambda value, operand: operand
+    }
+
+    def __init__(self, op, operand, step=None):
+        if op not in self.operators:
+            raise ValueError('Unknown operator: ' + str(op))
+        self.operation = self.operators[op]
+        try:
+            self.operand = self.number(operand)
+            self.step = self.number(step) if step else 0
+        except InvalidOperation:
+            raise ValueError('Invalid operand: ' + str(operand))
+        if op in ('/', '%') and not self.operand and not self.step:
+            raise ValueError('Division by zero')
+
+    @staticmethod
+    def modulo(value, operand):
+        # the result has the sign of the operand for ints and decimals alike
+        result = value % operand
+        if result and (result < 0) != (operand < 0):
+            result += operand
+        return result
+
+    @staticmethod
+    def number(text):
+        value = Decimal(str(text))
+        return int(value) if value == value.to_integral_value() else value
+
+    def apply(self, texts):
+        # returns the new values and the indexes of values that are not numbers
+        values = []
+        errors = []
+        operand = self.operand
+        for (index, text) in enumerate(texts):
+            number = NumberFormat.parse(text)
+            if number is None:
+                values.append(None)
+                errors.append(index)
+            else:
+                try:
+                    values.append(number.format(self.operation(number.value(), operand)))
+                except (DecimalException, ZeroDivisionError, ValueError):
+                    # a stepped operand can still hit zero
+                    values.append(None)
+                    errors.append(index)
+            operand += self.step
+        return (values, errors)
+
+
+class TextPastryArithmeticCommand(sublime_plugin.TextCommand):
+
+    def run(self, edit, operator="+", operand="1", step=None):
+        try:
+            bulk = BulkEdit(self.view, edit)
+            (values, errors) = Arithmetic(operator, operand, step).apply(bulk.texts())
+            bulk.select(bulk.replace(values), cursor=False)
+            if errors:
+                message = "Skipped {0} values that are not numbers or could not be computed, first at selection {1}".format(len(errors), errors[0] + 1)
+                sublime.status_message(message)
+                print('Text Pastry:', message)
+            else:
+                sublime.status_message("Updated {0} numbers".format(len(values)))
+        except ValueError as e:
+            sublime.status_message("Error while executing Arithmetic: " + str(e))
+
+
+# ========================================
+# stats.py
+# ========================================
+class HyperLogLog(object):
+    # distinct count estimate in constant memory, 2^precision one byte registers
+
+    def __init__(self, precision=14):
+        self.precision = precision
+        self.m = 1 << precision
+        self.registers = bytearray(self.m)
+        self.alpha = 0.7213 / (1 + 1.079 / self.m)
+
+    def add(self, value):
+        x = hash(value) & 0xFFFFFFFFFFFFFFFF
+        bits = 64 - self.precision
+        index = x >> bits
+        # position of the leftmost 1 bit in the remaining bits
+        rank = bits - (x & ((1 << bits) - 1)).bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def count(self):
+        estimate = self.alpha * self.m * self.m / sum(2.0 ** -r for r in self.registers)
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * self.m and zeros:
+            # linear counting for small cardinalities
+            estimate = self.m * math.log(float(self.m) / zeros)
+        return int(round(estimate))
+
+
+class SelectionStats(object):
+
+    def __init__(self, exact_limit=10000):
+        self.count = 0
+        self.empty = 0
+        self.numbers = 0
+        self.total = 0
+        self.minimum = None
+        self.maximum = None
+        self.exact_limit = exact_limit
+        self.distinct = set()
+        self.estimator = None
+
+    def add(self, text):
+        self.count += 1
+        if not text:
+            self.empty += 1
+        number = NumberFormat.parse(text)
+        if number is not None:
+            value = number.value()
+            self.numbers += 1
+            self.total += value
+            if self.minimum is None or value < self.minimum:
+                self.minimum = value
+            if self.maximum is None or value > self.maximum:
+                self.maximum = value
+        if self.estimator is not None:
+            self.estimator.add(text)
+        else:
+            self.distinct.add(text)
+            if len(self.distinct) > self.exact_limit:
+                # too many values to keep, switch to an estimate
+                self.estimator = HyperLogLog()
+                for value in self.distinct:
+                    self.estimator.add(value)
+                self.distinct = None
+
+    def distinct_count(self):
+        if self.estimator is not None:
+            return '~' + str(self.estimator.count())
+        return str(len(self.distinct))
+
+    def summary(self):
+        parts = [
+            "count: {0}".format(self.count),
+            "distinct: {0}".format(self.distinct_count()),
+            "numeric: {0}".format(self.numbers),
+            "non-numeric: {0}".format(self.count - self.numbers),
+            "empty: {0}".format(self.empty)
+        ]
+        if self.numbers:
+            parts.append("sum: {0}".format(self.total))
+            parts.append("min: {0}".format(self.minimum))
+            parts.append("max: {0}".format(self.maximum))
+            parts.append("avg: {0:.6g}".format(float(self.total) / self.numbers))
+        return parts
+
+
+class TextPastryStatsCommand(sublime_plugin.TextCommand):
+    chunk_size = 10000
+
+    def run(self, edit, panel=False):
+        stats = SelectionStats()
+        regions = iter(self.view.sel())
+        # read the selections chunk by chunk, one substr per chunk
+        while True:
+            chunk = list(itertools.islice(regions, self.chunk_size))
+            if not chunk:
+                break
+            for text in BulkEdit(self.view, edit, chunk).texts():
+                stats.add(text)
+        summary = stats.summary()
+        sublime.status_message("Text Pastry: " + ", ".join(summary))
+        if panel and self.view.window():
+            window = self.view.window()
+            output = window.create_output_panel("text_pastry_stats")
+            output.run_command("append", {"characters": "\n".join(summary) + "\n"})
+            window.run_command("show_panel", {"panel": "output.text_pastry_stats"})
+
+
+# ========================================
+# encode.py
+# ========================================
+class Encoder(object):
+    digests = ('md5', 'sha1', 'sha224', 'sha256', 'sha384', 'sha512')
+    encoders = {
+        'base64': lambda text: base64.b64encode(text.encode('UTF-8')).decode('ascii'),
+        'base64_decode': lambda text: base64.b64decode(text.encode('ascii'), validate=True).decode('UTF-8'),
+        'url': lambda text: urllib.parse.quote(text, safe=''),
+        'url_decode': lambda text: urllib.parse.unquote(text),
+        'hex': lambda text: binascii.hexlify(text.encode('UTF-8')).decode('ascii'),
+        'hex_decode': lambda text: binascii.unhexlify(text.encode('ascii')).decode('UTF-8')
+    }
+
+    @classmethod
+    def get(cls, name):
+        if name in cls.digests:
+            return lambda text: hashlib.new(name, text.encode('UTF-8')).hexdigest()
+        if name in cls.encoders:
+            return cls.encoders[name]
+        raise ValueError('Unknown encoding: ' + str(name))
+
+    @staticmethod
+    def batch(function, texts):
+        # invalid input stays None
+        results = []
+        for text in texts:
+            try:
+                results.append(function(text))
+            except ValueError:
+                results.append(None)
+        return results
+
+    @classmethod
+    def apply(cls, name, texts, workers=4, thread_threshold=2048):
+        function = cls.get(name)
+        # every distinct value is only encoded once
+        distinct = list(set(texts))
+        threaded = name in cls.digests and workers > 1 and len(distinct) > 1
+        if threaded and sum(len(text) for text in distinct) >= thread_threshold * len(distinct):
+            # hashlib only releases the GIL for inputs above 2KB, the other encoders hold it
+            step = (len(distinct) + workers - 1) // workers
+            batches = [distinct[idx:idx + step] for idx in range(0, len(distinct), step)]
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                results = list(itertools.chain.from_iterable(executor.map(lambda batch: cls.batch(function, batch), batches)))
+        else:
+            results = cls.batch(function, distinct)
+        cache = dict(zip(distinct, results))
+        return [cache[text] for text in texts]
+
+
+class TextPastryEncodeCommand(sublime_plugin.TextCommand):
+
+    def run(self, edit, encoding="md5"):
+        try:
+            settings = sublime.load_settings("TextPastry.sublime-settings")
+            bulk = BulkEdit(self.view, edit)
+            values = Encoder.apply(encoding, bulk.texts(),
+                                   settings.get("encode_workers", 4),
+                                   settings.get("encode_thread_threshold", 2048))
+            bulk.select(bulk.replace(values), cursor=False)
+            errors = values.count(None)
+            if errors:
+                sublime.status_message("Skipped {0} selections that could not be decoded".format(errors))
+        except ValueError as e:
+            sublime.status_message("Error while encoding: " + str(e))
+
+
+# ========================================
+# template.py
+# ========================================
+class Template(object):
+    _cache = {}
+    max_cache_size = 100
+
+    @classmethod
+    def compile(cls, template):
+        # literals stay strings, fields become closures of (index, value, number)
+        if template in cls._cache:
+            return cls._cache[template]
+        parts = []
+        for (literal, field, spec, conversion) in string.Formatter().parse(template):
+            if literal:
+                parts.append(literal)
+            if field is not None:
+                parts.append(cls.field(field, spec or '', conversion))
+        if len(cls._cache) >= cls.max_cache_size:
+            cls._cache.clear()
+        cls._cache[template] = parts
+        return parts
+
+    @staticmethod
+    def field(name, spec, conversion):
+        if name == 'i':
+            field = lambda index, value, number: number
+        elif name == 'index':
+            field = lambda index, value, number: index
+        elif name == 'value':
+            field = lambda index, value, number: value
+        elif name in ('uuid', 'UUID'):
+            uppercase = name == 'UUID'
+            field = lambda index, value, number: UUIDCommand.generate(uppercase)
+        else:
+            raise ValueError('Unknown template field: ' + name)
+        if conversion:
+            conversions = {'r': repr, 's': str, 'a': ascii}
+            if conversion not in conversions:
+                raise ValueError('Unknown conversion: ' + conversion)
+            convert = conversions[conversion]
+            return lambda index, value, number: format(convert(field(index, value, number)), spec)
+        if not spec and name == 'value':
+            return field
+        return lambda index, value, number: format(field(index, value, number), spec)
+
+    @staticmethod
+    def unquote(template):
+        # allow quoted templates from the command line
+        if len(template) > 1 and template[0] == template[-1] and template[0] in '"\'':
+            return template[1:-1]
+        return template
+
+    @staticmethod
+    def apply(parts, index, value, number):
+        return ''.join([part if isinstance(part, str) else part(index, value, number) for part in parts])
+
+    @classmethod
+    def render(cls, template, values, current=1, step=1):
+        parts = cls.compile(template)
+        return [cls.apply(parts, index, value, current + index * step) for (index, value) in enumerate(values)]
+
+
+class TextPastryFormatCommand(sublime_plugin.TextCommand):
+
+    def run(self, edit, template, current="1", step="1"):
+        try:
+            bulk = BulkEdit(self.view, edit)
+            values = Template.render(Template.unquote(template), bulk.texts(), int(current), int(step))
+            bulk.select(bulk.replace(values))
+        except ValueError as e:
+            sublime.status_message("Error while executing Format: " + str(e))
+
+
+# ========================================
+# preview.py
+# ========================================
+class PreviewItems(object):
+    # pulls items from a generator only as far as the preview needs them
+
+    def __init__(self, generator):
+        self.generator = generator
+        self.items = []
+
+    def get(self, index):
+        while len(self.items) <= index and self.generator is not None:
+            try:
+                self.items.append(next(self.generator))
+            except StopIteration:
+                self.generator = None
+        return self.items[index] if index < len(self.items) else None
+
+
+class CommandPreview(object):
+    key = 'text_pastry_preview'
+    template = '<body id="text-pastry-preview"><span style="color: var(--greenish)">{0}</span></body>'
+
+    def __init__(self, view):
+        self.view = view
+        self.phantoms = sublime.PhantomSet(view, self.key)
+        self.parser = Parser()
+        self.settings = sublime.load_settings("TextPastry.sublime-settings")
+        self.cache_key = None
+        self.renderer = None
+        self.token = 0
+
+    def update(self, text):
+        # debounce, only the last keystroke within the delay is rendered
+        self.token += 1
+        token = self.token
+        delay = self.settings.get("preview_delay", 150)
+        sublime.set_timeout(lambda: self.render(token, text), delay)
+
+    def clear(self):
+        self.token += 1
+        self.cache_key = None
+        self.renderer = None
+        self.phantoms.update([])
+
+    def render(self, token, text):
+        if token != self.token:
+            return
+        phantoms = []
+        try:
+            renderer = self.resolve(text)
+            if renderer:
+                regions = self.visible_selections()
+                texts = BulkEdit(self.view, None, [region for (index, region) in regions]).texts()
+                for ((index, region), value) in zip(regions, texts):
+                    # lazy sources (e.g. structured data) fail here, not in resolve
+                    value = renderer(index, value)
+                    if value is not None:
+                        content = self.template.format(html.escape(value).replace('\n', '<br>'))
+                        phantoms.append(sublime.Phantom(sublime.Region(region.end()), content, sublime.LAYOUT_INLINE))
+        except (ValueError, re.error):
+            phantoms = []
+        self.phantoms.update(phantoms)
+
+    def resolve(self, text):
+        # line mode has no selections to render a preview for
+        if not text or self.parser.line_mode(text):
+            return None
+        cmd_shortcuts = self.settings.get('cmd_shortcuts', [])
+        (item, match) = self.parser.match(text, cmd_shortcuts)
+        if item:
+            key = (item['match'], match.groups())
+        else:
+            key = ('words', text)
+        # the prefix still resolves to the same command, reuse the parse
+        if key == self.cache_key:
+            return self.renderer
+        if item:
+            command = self.parser.create_command(item, self.parser.references(match))
+        else:
+            command = dict(command='text_pastry_insert_text', args={'text': text, 'threshold': self.settings.get('insert_text_threshold', 3)})
+        self.cache_key = key
+        self.renderer = self.create_renderer(command['command'], command.get('args') or {})
+        return self.renderer
+
+    def create_renderer(self, command, args):
+        if command == 'insert_nums':
+            current = int(args.get('current', 1))
+            step = int(args.get('step', 1))
+            padding = '0' + str(args.get('padding', 1)) + 'd'
+            return lambda index, value: format(current + index * step, padding)
+        elif command == 'text_pastry_convert_case':
+            case = args.get('case', 'snake')
+            return lambda index, value: CaseConverter.convert(value, case)
+        elif command == 'text_pastry_format':
+            parts = Template.compile(Template.unquote(args.get('template', '')))
+            current = int(args.get('current', 1))
+            step = int(args.get('step', 1))
+            return lambda index, value: Template.apply(parts, index, value, current + index * step)
+        elif command == 'upper_case':
+            return lambda index, value: value.upper()
+        elif command == 'lower_case':
+            return lambda index, value: value.lower()
+        elif command == 'text_pastry_insert_text':
+            return self.create_insert_text_renderer(args)
+        return None
+
+    def create_insert_text_renderer(self, args):
+        text = sublime.get_clipboard() if args.get('clipboard') else args.get('text')
+        if args.get('clipboard') and args.get('ring'):
+            text = ClipboardRing.clipboard(args['ring'])
+        if not text or args.get('sample'):
+            # random samples would not match what gets inserted
+            return None
+        separator = args.get('separator')
+        if separator:
+            separator = separator.encode('utf8').decode("unicode-escape")
+        if args.get('structured'):
+            reader = StructuredReader(text, args['structured'], column=args.get('column'), key=args.get('key'), rows=args.get('rows'))
+            items = PreviewItems(reader.records())
+        else:
+            threshold = args.get('threshold', 1)
+            segments = Splitter.split(text, separator, args.get('regex', False))
+            items = PreviewItems(segments)
+            if items.get(threshold - 1) is None:
+                return None
+        strip = separator == "\n" and self.settings.get("clipboard_strip_newline", False)
+        def renderer(index, value):
+            item = items.get(index)
+            if item is not None and strip:
+                item = item.strip()
+            return item
+        return renderer
+
+    def visible_selections(self):
+        # binary search for the first visible selection, so the cost does not depend on the number of cursors
+        sel = self.view.sel()
+        visible = self.view.visible_region()
+        low = 0
+        high = len(sel)
+        while low < high:
+            middle = (low + high) // 2
+            if sel[middle].end() < visible.begin():
+                low = middle + 1
+            else:
+                high = middle
+        regions = []
+        limit = self.settings.get("preview_max_phantoms", 200)
+        index = low
+        size = len(sel)
+        while index < size and len(regions) < limit:
+            region = sel[index]
+            if region.begin() > visible.end():
+                break
+            regions.append((index, region))
+            index += 1
+        return regions
+
+
 # ========================================
 # command_line.py
 # ========================================
@@ -716,6 +2130,7 @@ class TextPastryShowCommandLine(sublime_plugin.WindowCommand):
         self.show_input_panel('Text Pastry Command:', text)
 
     def on_done(self, text):
+        self.clear_preview()
         parser = Parser()
         result = parser.parse(text)
         if result and 'command' in result:
@@ -725,9 +2140,25 @@ class TextPastryShowCommandLine(sublime_plugin.WindowCommand):
             args = result['args'] if 'args' in result else None
             self.window.active_view().run_command(command, args)
 
+    def on_change(self, text):
+        if self.preview:
+            self.preview.update(text)
+
+    def on_cancel(self):
+        self.clear_preview()
+
+    def clear_preview(self):
+        if self.preview:
+            self.preview.clear()
+            self.preview = None
+
     def show_input_panel(self, label, text):
         HistoryHandler.index = 0
-        view = self.window.show_input_panel(label, text, self.on_done, None, None)
+        self.preview = None
+        settings = sublime.load_settings("TextPastry.sublime-settings")
+        if settings.get("preview_enabled", True) and hasattr(sublime, 'PhantomSet'):
+            self.preview = CommandPreview(self.window.active_view())
+        view = self.window.show_input_panel(label, text, self.on_done, self.on_change, self.on_cancel)
         settings = view.settings()
         # this will be a setting in 1.4.0
         #settings.set('color_scheme', 'Packages/Color Scheme - Default/Mac Classic.tmTheme')
@@ -751,10 +2182,17 @@ class TextPastryShowCommandLine(sublime_plugin.WindowCommand):
 # ========================================
 class TextPastryCommandWrapperCommand(sublime_plugin.TextCommand):
 
-    def run(self, edit, command, args=None, text=None, separator=None, items=None):
+    def run(self, edit, command, args=None, text=None, separator=None, items=None,
+            lines=False, pattern=None, first_line=None, last_line=None, position="start"):
         try:
             cmd = Command.create(command, args)
-            if cmd:
+            if cmd and lines:
+                if text:
+                    items = text.split(separator)
+                cmd.init(self.view, items)
+                line_mode = LineMode(self.view, pattern, first_line, last_line, position)
+                line_mode.apply(edit, lambda index, line, region: cmd.next(line, index, region) if cmd.has_next() else None)
+            elif cmd:
                 items = items
                 if text:
                     items = text.split(separator)
@@ -780,6 +2218,8 @@ class TextPastryCommandWrapperCommand(sublime_plugin.TextCommand):
         except ValueError:
             sublime.status_message("Error while executing Text Pastry, canceled")
             pass
+        except re.error as e:
+            sublime.status_message("Invalid line pattern: " + str(e))
 
 
 # ========================================
@@ -827,11 +2267,13 @@ class TextPastryShowMenu(sublime_plugin.WindowCommand):
         clipboard_strip_newline = settings.get("clipboard_strip_newline", False)
         keep_selection = settings.get("keep_selection", False)
         force_uppercase_uuid = settings.get("force_uppercase_uuid", False)
+        preview_enabled = settings.get("preview_enabled", True)
         self.overlay.addSetting("repeat_words", repeat_words)
         self.overlay.addSetting("repeat_clipboard", repeat_clipboard)
         self.overlay.addSetting("clipboard_strip_newline", clipboard_strip_newline)
         self.overlay.addSetting("keep_selection", keep_selection)
         self.overlay.addSetting("force_uppercase_uuid", force_uppercase_uuid)
+        self.overlay.addSetting("preview_enabled", preview_enabled)
         self.overlay.addSpacer()
         self.overlay.addMenuItem(command="default", args={"file": sublime.packages_path() + "/Text Pastry/TextPastry.sublime-settings"}, label="Open default settings")
         self.overlay.addMenuItem(command="user", args={"file": sublime.packages_path() + "/User/TextPastry.sublime-settings"}, label="Open user settings")